@@ -13,9 +13,16 @@ import threading
 import time
 import queue
 import atexit
-from flask import Flask, render_template_string, request, flash, redirect, url_for
-from flask_wtf import FlaskForm, CSRFProtect
-from wtforms import TextAreaField, StringField, HiddenField
+import codecs
+import functools
+import gzip
+import hashlib
+import hmac
+import re
+import secrets
+from collections import deque
+from flask import Flask, Response, request, flash, redirect, url_for, session, get_flashed_messages
+from wtforms import Form, TextAreaField, StringField
 from wtforms.validators import DataRequired, Length
 from datetime import datetime
 
@@ -26,8 +33,9 @@ from datetime import datetime
 app = Flask(__name__, static_folder='static')
 app.secret_key = os.environ.get('SECRET_KEY', 'dev-key-change-in-production')
 
-# CSRF Protection
-csrf = CSRFProtect(app)
+# Static assets are immutable between deploys - cache them for a year
+# and rely on the ?v= content hash below to bust the cache on change
+app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 31536000
 
 # Printer settings
 PRINTER_HOST = os.environ.get('PRINTER_HOST', '172.29.208.1')
@@ -40,69 +48,137 @@ DATA_DIR = os.path.join(BASE_DIR, 'data')
 RATE_LIMIT_FILE = os.path.join(DATA_DIR, 'rate_limits.json')
 QUEUE_FILE = os.path.join(DATA_DIR, 'print_queue.json')
 
+# Rewrite the queue journal after this many completed jobs
+QUEUE_COMPACT_JOBS = 10
+
 # Rate limiting
 RATE_LIMIT_SECONDS = int(os.environ.get('RATE_LIMIT_SECONDS', '60'))
+RATE_LIMIT_FLUSH_SECONDS = int(os.environ.get('RATE_LIMIT_FLUSH_SECONDS', '30'))
+
+# Hard cap on tracked IPs so a flood of unique addresses can't grow the
+# rate-limit dict without bound; oldest entries are evicted first
+RATE_LIMIT_MAX_IPS = int(os.environ.get('RATE_LIMIT_MAX_IPS', '100000'))
 
 # Print queue settings
 PRINT_DELAY_SECONDS = int(os.environ.get('PRINT_DELAY_SECONDS', '5'))
 
+# How many backlogged jobs get coalesced into one send to the printer
+PRINT_BATCH_JOBS = int(os.environ.get('PRINT_BATCH_JOBS', '5'))
+
+# Cap for the exponential backoff when the printer looks offline
+PRINT_MAX_BACKOFF_SECONDS = int(os.environ.get('PRINT_MAX_BACKOFF_SECONDS', '60'))
+
 # Ensure directories exist
 os.makedirs(MESSAGES_DIR, exist_ok=True)
 os.makedirs(DATA_DIR, exist_ok=True)
 
 # =============================================================================
-# Rate Limiting (File-based, persists across restarts)
+# Rate Limiting (In-memory, flushed to file so it persists across restarts)
 # =============================================================================
 
 rate_limit_lock = threading.Lock()
 
 
 def load_rate_limits():
-    """Load rate limits from file."""
+    """Load rate limits (epoch seconds per IP) from file."""
     if os.path.exists(RATE_LIMIT_FILE):
         try:
             with open(RATE_LIMIT_FILE, 'r') as f:
                 data = json.load(f)
-                # Convert string timestamps back to datetime
-                return {ip: datetime.fromisoformat(ts) for ip, ts in data.items()}
+            limits = {}
+            for ip, ts in data.items():
+                if isinstance(ts, str):
+                    # Legacy format: ISO timestamps from before the
+                    # switch to plain epoch floats
+                    ts = datetime.fromisoformat(ts).timestamp()
+                limits[ip] = ts
+            return limits
         except (json.JSONDecodeError, ValueError):
             return {}
     return {}
 
 
 def save_rate_limits(limits):
-    """Save rate limits to file."""
-    # Convert datetime to ISO format strings
-    data = {ip: ts.isoformat() for ip, ts in limits.items()}
-    with open(RATE_LIMIT_FILE, 'w') as f:
-        json.dump(data, f)
+    """Save rate limits to file (atomically, via a temp file)."""
+    tmp_file = RATE_LIMIT_FILE + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(limits, f)
+    os.replace(tmp_file, RATE_LIMIT_FILE)
+
+
+# Loaded once at startup; requests only touch this dict, never the disk
+rate_limits = load_rate_limits()
+
+# Insertion log (timestamp, ip) ordered oldest-first, so expired entries
+# can be evicted from the front without scanning the whole dict
+rate_limit_events = deque(sorted((ts, ip) for ip, ts in rate_limits.items()))
 
 
 def check_rate_limit(visitor_ip):
-    """Check if IP is rate limited. Returns (allowed, seconds_remaining)."""
+    """Check if IP is rate limited. Returns (allowed, seconds_remaining).
+
+    Lock-free: a single dict.get is atomic under the GIL, and the worst
+    a racing writer can do is make the answer stale by one submission.
+    Only writers (record_submission, flush_rate_limits) take the lock.
+    """
+    last_seen = rate_limits.get(visitor_ip)
+    if last_seen is not None:
+        elapsed = time.time() - last_seen
+        if elapsed < RATE_LIMIT_SECONDS:
+            return False, int(RATE_LIMIT_SECONDS - elapsed)
+    return True, 0
+
+
+def record_submission(visitor_ip, now):
+    """Record a successful submission (epoch seconds) for rate limiting."""
+    with rate_limit_lock:
+        # Evict expired entries from the front of the insertion log;
+        # amortised O(1) per submission instead of a full dict scan
+        while rate_limit_events:
+            ts, ip = rate_limit_events[0]
+            if now - ts < RATE_LIMIT_SECONDS:
+                break
+            rate_limit_events.popleft()
+            # Only drop the dict entry if it wasn't refreshed since
+            if rate_limits.get(ip) == ts:
+                del rate_limits[ip]
+        # Evict oldest entries if a flood of unique IPs hits the cap
+        while len(rate_limits) >= RATE_LIMIT_MAX_IPS and rate_limit_events:
+            ts, ip = rate_limit_events.popleft()
+            if rate_limits.get(ip) == ts:
+                del rate_limits[ip]
+        rate_limits[visitor_ip] = now
+        rate_limit_events.append((now, visitor_ip))
+
+
+def flush_rate_limits():
+    """Prune expired entries and persist a snapshot to disk."""
+    now = time.time()
     with rate_limit_lock:
-        limits = load_rate_limits()
-        now = datetime.now()
+        expired = [ip for ip, ts in rate_limits.items()
+                   if now - ts >= RATE_LIMIT_SECONDS]
+        for ip in expired:
+            del rate_limits[ip]
+        snapshot = dict(rate_limits)
+    save_rate_limits(snapshot)
 
-        # Clean old entries (older than rate limit)
-        limits = {ip: ts for ip, ts in limits.items()
-                  if (now - ts).total_seconds() < RATE_LIMIT_SECONDS}
 
-        if visitor_ip in limits:
-            time_since_last = (now - limits[visitor_ip]).total_seconds()
-            if time_since_last < RATE_LIMIT_SECONDS:
-                remaining = int(RATE_LIMIT_SECONDS - time_since_last)
-                return False, remaining
+def rate_limit_flusher():
+    """Background worker that periodically flushes rate limits to disk."""
+    while True:
+        time.sleep(RATE_LIMIT_FLUSH_SECONDS)
+        try:
+            flush_rate_limits()
+        except Exception as e:
+            print(f"[RateLimit] Flush error: {e}")
 
-        return True, 0
 
+# Start flusher thread
+flusher_thread = threading.Thread(target=rate_limit_flusher, daemon=True)
+flusher_thread.start()
 
-def record_submission(visitor_ip):
-    """Record a successful submission for rate limiting."""
-    with rate_limit_lock:
-        limits = load_rate_limits()
-        limits[visitor_ip] = datetime.now()
-        save_rate_limits(limits)
+# Flush on shutdown so restarts don't forget recent submissions
+atexit.register(flush_rate_limits)
 
 
 # =============================================================================
@@ -111,81 +187,124 @@ def record_submission(visitor_ip):
 
 print_queue = queue.Queue()
 queue_lock = threading.Lock()
+queue_file_lock = threading.Lock()
 
 
 def load_pending_queue():
     """Load any pending jobs from file (survives restarts)."""
-    if os.path.exists(QUEUE_FILE):
-        try:
-            with open(QUEUE_FILE, 'r') as f:
-                jobs = json.load(f)
-                for job in jobs:
-                    print_queue.put(job)
-                # Clear the file after loading
-                os.remove(QUEUE_FILE)
-        except (json.JSONDecodeError, ValueError):
-            pass
-
-
-def save_pending_queue():
-    """Save pending jobs to file (for graceful shutdown)."""
-    jobs = []
-    while not print_queue.empty():
-        try:
-            jobs.append(print_queue.get_nowait())
-        except queue.Empty:
-            break
-    if jobs:
+    if not os.path.exists(QUEUE_FILE):
+        return
+    try:
+        with open(QUEUE_FILE, 'r') as f:
+            raw = f.read().strip()
+    except OSError:
+        return
+    if not raw:
+        return
+    try:
+        if raw.startswith('['):
+            # Legacy format: a single JSON array from before the journal
+            jobs = json.loads(raw)
+        else:
+            # Journal format: one JSON job per line
+            jobs = [json.loads(line) for line in raw.splitlines() if line.strip()]
+    except (json.JSONDecodeError, ValueError):
+        return
+    for job in jobs:
+        print_queue.put(job)
+
+
+def compact_queue_file():
+    """Rewrite the queue journal with only the jobs still pending."""
+    with queue_file_lock:
+        with print_queue.mutex:
+            pending = list(print_queue.queue)
         with open(QUEUE_FILE, 'w') as f:
-            json.dump(jobs, f)
+            for job in pending:
+                if job is not None:  # Skip the shutdown sentinel
+                    f.write(json.dumps(job) + '\n')
 
 
 def print_worker():
     """Background worker that processes the print queue."""
+    jobs_done = 0
+    consecutive_failures = 0
     while True:
-        try:
-            job = print_queue.get(timeout=1)
-            if job is None:  # Shutdown signal
-                break
+        # Block until a job arrives - no periodic polling wakeups
+        job = print_queue.get()
+        if job is None:  # Shutdown signal
+            break
 
-            message = job['message']
-            visitor_ip = job['visitor_ip']
+        # Coalesce a backlog into one payload and one socket write; each
+        # message still ends with its own FEED so the printed output is
+        # unchanged
+        batch = [job]
+        stopping = False
+        while len(batch) < PRINT_BATCH_JOBS:
+            try:
+                extra = print_queue.get_nowait()
+            except queue.Empty:
+                break
+            if extra is None:
+                stopping = True
+                break
+            batch.append(extra)
 
-            success, result = send_to_printer_internal(message, visitor_ip)
+        try:
+            payload = b"".join(build_print_payload(j['message'], j['visitor_ip'])
+                               for j in batch)
+            success, result = send_payload(payload)
             if not success:
-                print(f"[PrintQueue] Failed to print: {result}")
+                # Printer looks offline: keep the jobs and back off
+                # exponentially instead of burning through the queue
+                for j in batch:
+                    print_queue.put(j)
+                consecutive_failures += 1
+                delay = min(PRINT_DELAY_SECONDS * (2 ** (consecutive_failures - 1)),
+                            PRINT_MAX_BACKOFF_SECONDS)
+                print(f"[PrintQueue] Failed to print: {result} (retrying in {delay}s)")
             else:
-                print(f"[PrintQueue] Printed message from {visitor_ip}")
+                consecutive_failures = 0
+                delay = PRINT_DELAY_SECONDS
+                for j in batch:
+                    print(f"[PrintQueue] Printed message from {j['visitor_ip']}")
 
-            print_queue.task_done()
+            for _ in batch:
+                print_queue.task_done()
 
-            # Delay between prints to prevent printer overload
-            time.sleep(PRINT_DELAY_SECONDS)
+            # Rewrite the journal every so often so completed jobs don't
+            # get re-printed after a crash
+            jobs_done += len(batch)
+            if jobs_done >= QUEUE_COMPACT_JOBS:
+                jobs_done = 0
+                compact_queue_file()
+
+            # Delay between batches to prevent printer overload
+            time.sleep(delay)
 
-        except queue.Empty:
-            continue
         except Exception as e:
             print(f"[PrintQueue] Worker error: {e}")
 
+        if stopping:
+            break
 
-# Start worker thread
-worker_thread = threading.Thread(target=print_worker, daemon=True)
-worker_thread.start()
-
-# Load any pending jobs from previous run
-load_pending_queue()
 
-# Save queue on shutdown
-atexit.register(save_pending_queue)
+def stop_print_worker():
+    """Signal the worker to exit after the jobs queued ahead of it."""
+    print_queue.put(None)
 
 
-def queue_print_job(message, visitor_ip):
+def queue_print_job(message, visitor_ip, now):
     """Add a print job to the queue."""
     job = {
         'message': message,
         'visitor_ip': visitor_ip,
-        'queued_at': datetime.now().isoformat()
+        'queued_at': now.isoformat()
     }
+    # Journal the job first so a hard kill can't lose it
+    with queue_file_lock:
+        with open(QUEUE_FILE, 'a') as f:
+            f.write(json.dumps(job) + '\n')
     print_queue.put(job)
     return print_queue.qsize()
 
@@ -194,8 +313,12 @@ def queue_print_job(message, visitor_ip):
 # Form with Honeypot
 # =============================================================================
 
-class MessageForm(FlaskForm):
-    """Form with honeypot field for bot detection."""
+class MessageForm(Form):
+    """Form with honeypot field for bot detection.
+
+    A plain wtforms Form: CSRF is handled by the double-submit cookie in
+    the view, so there's no FlaskForm/itsdangerous machinery per request.
+    """
     message = TextAreaField('Message', validators=[
         DataRequired(message='Please enter a message!'),
         Length(max=240, message='Message too long (max 240 characters)')
@@ -215,10 +338,6 @@ HTML_TEMPLATE = '''
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>Send me a message</title>
-    <link rel="preconnect" href="https://fonts.googleapis.com">
-    <link rel="preconnect" href="https://fonts.gstatic.com" crossorigin>
-    <link href="https://fonts.googleapis.com/css2?family=JetBrains+Mono:wght@400;500;600&display=swap" rel="stylesheet">
-
     <!-- Favicon and PWA -->
     <link rel="icon" type="image/x-icon" href="/static/favicon.ico">
     <link rel="icon" type="image/png" sizes="32x32" href="/static/favicon-32.png">
@@ -237,7 +356,7 @@ HTML_TEMPLATE = '''
         }
 
         body {
-            font-family: 'JetBrains Mono', monospace;
+            font-family: ui-monospace, 'JetBrains Mono', Menlo, Consolas, monospace;
             min-height: 100vh;
             background: #0a0a0a;
             display: flex;
@@ -292,7 +411,7 @@ HTML_TEMPLATE = '''
             border: 1px solid #222;
             border-radius: 6px;
             font-size: 14px;
-            font-family: 'JetBrains Mono', monospace;
+            font-family: ui-monospace, 'JetBrains Mono', Menlo, Consolas, monospace;
             color: #fff;
             resize: none;
             transition: border-color 0.2s;
@@ -324,7 +443,7 @@ HTML_TEMPLATE = '''
             border-radius: 6px;
             font-size: 14px;
             font-weight: 500;
-            font-family: 'JetBrains Mono', monospace;
+            font-family: ui-monospace, 'JetBrains Mono', Menlo, Consolas, monospace;
             cursor: pointer;
             transition: all 0.2s;
         }
@@ -393,14 +512,12 @@ HTML_TEMPLATE = '''
             </div>
             <p class="subtitle">and it will print on my thermal printer at home</p>
 
-            {% with messages = get_flashed_messages(with_categories=true) %}
-                {% for category, message in messages %}
-                    <div class="flash {{ category }}">{{ message }}</div>
-                {% endfor %}
-            {% endwith %}
+            {% for category, message in messages %}
+                <div class="flash {{ category }}">{{ message }}</div>
+            {% endfor %}
 
             <form method="POST" id="printForm">
-                {{ form.hidden_tag() }}
+                <input type="hidden" name="_csrf" value="{{ csrf_token }}">
                 <textarea
                     name="message"
                     placeholder="type something..."
@@ -438,134 +555,512 @@ HTML_TEMPLATE = '''
 </html>
 '''
 
+def _static_version():
+    """Short content hash of the static assets, used as a cache-bust token."""
+    h = hashlib.sha1()
+    static_dir = os.path.join(BASE_DIR, 'static')
+    for name in sorted(os.listdir(static_dir)):
+        path = os.path.join(static_dir, name)
+        if os.path.isfile(path):
+            with open(path, 'rb') as f:
+                h.update(f.read())
+    return h.hexdigest()[:8]
+
+
+STATIC_VERSION = _static_version()
+
+# Stamp the cache-bust token into the icon URLs before compiling. This
+# must run before minification: htmlmin strips attribute quotes, so the
+# trailing-quote anchors below wouldn't match afterwards
+HTML_TEMPLATE = (HTML_TEMPLATE
+                 .replace('.ico"', f'.ico?v={STATIC_VERSION}"')
+                 .replace('.png"', f'.png?v={STATIC_VERSION}"'))
+
+# Minify once at import if htmlmin is available; the template is static
+# apart from Jinja tags, so this shrinks every response for free
+try:
+    import htmlmin
+    HTML_TEMPLATE = htmlmin.minify(HTML_TEMPLATE, remove_comments=True,
+                                   remove_empty_space=True)
+except ImportError:
+    pass
+
+# Compile the template once at import time; render_template_string would
+# re-parse the string on every request
+_TEMPLATE = app.jinja_env.from_string(HTML_TEMPLATE)
+
+_CSRF_PLACEHOLDER = b'__CSRF_TOKEN__'
+
+# What a token we minted looks like (token_urlsafe alphabet). Anything
+# else in the cookie was tampered with and must not reach the page
+_CSRF_TOKEN_RE = re.compile(r'[A-Za-z0-9_-]{16,64}')
+
+
+def _prebake_html():
+    """Render the page once with a placeholder where the CSRF token goes.
+
+    A GET with no flashed messages (the overwhelmingly common request)
+    can then be served from these bytes with a single replace, skipping
+    Jinja entirely.
+    """
+    html = _TEMPLATE.render(form=MessageForm(), messages=[],
+                            csrf_token=_CSRF_PLACEHOLDER.decode('ascii'))
+    return html.encode('utf-8')
+
+
+_PREBAKED_HTML = _prebake_html()
+
 
 # =============================================================================
-# Printer Functions
+# Message Archive (Background writer thread)
 # =============================================================================
 
-def save_message(message, visitor_ip):
-    """Save a message to a markdown file with YAML frontmatter."""
-    now = datetime.now()
-    timestamp = now.strftime("%Y-%m-%d_%H-%M-%S")
-    filename = f"{timestamp}.md"
-    filepath = os.path.join(MESSAGES_DIR, filename)
+save_queue = queue.Queue()
+
+# One archive file per month, kept open between writes. A raw O_APPEND
+# fd skips the TextIOWrapper layer, so a whole batch goes to the kernel
+# in a single write() syscall
+_messages_fd = None
+_messages_month = None
+
+
+def _get_messages_fd(month):
+    """Return the append fd for this month's archive, rolling over if needed."""
+    global _messages_fd, _messages_month
+    if _messages_fd is None or _messages_month != month:
+        if _messages_fd is not None:
+            os.close(_messages_fd)
+        filepath = os.path.join(MESSAGES_DIR, f"{month}.md")
+        new_file = not os.path.exists(filepath)
+        _messages_fd = os.open(filepath, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        if new_file:
+            # Sync the directory so the new archive's entry survives a
+            # crash too, not just the bytes appended to it
+            dir_fd = os.open(MESSAGES_DIR, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+        _messages_month = month
+    return _messages_fd
+
+
+def save_worker():
+    """Background worker that appends queued messages to the archive.
+
+    Messages that arrive while a write is in progress are drained and
+    written back-to-back, so a burst costs one flush instead of one per
+    message (group commit).
+    """
+    while True:
+        item = save_queue.get()
+        if item is None:  # Shutdown signal
+            break
+
+        batch = [item]
+        stopping = False
+        while True:
+            try:
+                extra = save_queue.get_nowait()
+            except queue.Empty:
+                break
+            if extra is None:
+                stopping = True
+                break
+            batch.append(extra)
+
+        try:
+            # Coalesce the batch into one buffer per archive file (a month
+            # rollover mid-batch is the only way to get more than one)
+            buf = []
+            buf_month = batch[0][0]
+            for month, record in batch:
+                if month != buf_month:
+                    fd = _get_messages_fd(buf_month)
+                    os.write(fd, ''.join(buf).encode('utf-8'))
+                    os.fdatasync(fd)
+                    buf = []
+                    buf_month = month
+                buf.append(record)
+            fd = _get_messages_fd(buf_month)
+            os.write(fd, ''.join(buf).encode('utf-8'))
+            # One sync per batch: the whole burst hits the platter together,
+            # and a crash can no longer lose messages sitting in page cache
+            os.fdatasync(fd)
+        except Exception as e:
+            print(f"[SaveQueue] Worker error: {e}")
+        finally:
+            for _ in batch:
+                save_queue.task_done()
+
+        if stopping:
+            break
+
 
-    content = f"""---
+def stop_save_worker():
+    """Signal the writer to exit after the messages queued ahead of it."""
+    save_queue.put(None)
+
+
+def drain_save_queue():
+    """Write any still-queued messages and close the archive before shutdown."""
+    global _messages_fd
+    while not save_queue.empty():
+        try:
+            item = save_queue.get_nowait()
+        except queue.Empty:
+            break
+        if item is None:
+            continue
+        month, record = item
+        try:
+            os.write(_get_messages_fd(month), record.encode('utf-8'))
+        except OSError as e:
+            print(f"[SaveQueue] Drain error: {e}")
+    if _messages_fd is not None:
+        try:
+            os.fdatasync(_messages_fd)
+            os.close(_messages_fd)
+        except OSError:
+            pass
+        _messages_fd = None
+
+
+# Start writer thread
+save_thread = threading.Thread(target=save_worker, daemon=True)
+save_thread.start()
+
+# On shutdown: wake the writer with the sentinel, then write out
+# anything it didn't get to (atexit runs these last-in first-out)
+atexit.register(drain_save_queue)
+atexit.register(stop_save_worker)
+
+
+def save_message(message, visitor_ip, now):
+    """Queue a message for appending to this month's markdown archive.
+
+    Each record keeps the YAML frontmatter format; the actual disk write
+    happens on the writer thread so a slow disk can't block the request.
+    """
+    date_str = now.strftime("%Y-%m-%d")
+
+    record = f"""---
 from: {visitor_ip}
-date: {now.strftime("%Y-%m-%d")}
+date: {date_str}
 time: {now.strftime("%H:%M:%S")}
 ---
 
 {message}
+
 """
 
-    with open(filepath, 'w', encoding='utf-8') as f:
-        f.write(content)
+    # The month key is just the date's year-month prefix
+    save_queue.put((date_str[:7], record))
+
+
+# =============================================================================
+# Printer Functions
+# =============================================================================
+
+
+# ESC/POS commands for formatting
+INIT = b'\x1b\x40'  # Initialize printer
+LEFT = b'\x1b\x61\x00'  # Left align
+FEED = b'\r\n\r\n\r\n\r\n\r\n\r\n'  # Feed paper
+
+# Every job starts with init + blank line + left align; combine once
+PRELUDE = INIT + b'\r\n' + LEFT
+
+# Wrap text to 48 characters (typical for 80mm thermal paper). One
+# shared wrapper: textwrap.fill builds a TextWrapper (and compiles its
+# regexes) on every call
+_WRAPPER = textwrap.TextWrapper(width=48)
+
+# Bind the cp1252 encoder once instead of going through the codec
+# registry on every str.encode call
+_CP1252_ENCODE = codecs.getencoder('cp1252')
+
+
+def _encode_printer_text(text):
+    """Encode text for the printer; ASCII (the common case) takes
+    CPython's fast path, anything else falls back to cp1252."""
+    if text.isascii():
+        return text.encode('ascii')
+    return _CP1252_ENCODE(text, 'replace')[0]
+
+
+@functools.lru_cache(maxsize=256)
+def _encode_body(message):
+    """Wrap and encode a message body; memoised because repeat
+    submissions of the same text (retries, copy-paste) are common."""
+    return _encode_printer_text(_WRAPPER.fill(message))
+
+# Persistent connection to the printer bridge. The print worker is the
+# only sender and serialises jobs, so one long-lived socket is enough -
+# it saves a TCP handshake per message when jobs come in bursts.
+_printer_sock = None
+
+# Guards the socket: the worker sends on it, but the atexit close runs
+# on the main thread and must not yank it mid-send
+_printer_lock = threading.RLock()
 
 
-def send_to_printer_internal(message, visitor_ip):
-    """Send a message to the thermal printer via TCP bridge."""
+def _resolve_printer_addr():
+    """Resolve the printer address once so each connect skips getaddrinfo."""
     try:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.settimeout(5)
-        sock.connect((PRINTER_HOST, PRINTER_PORT))
-
-        # ESC/POS commands for formatting
-        INIT = b'\x1b\x40'  # Initialize printer
-        LEFT = b'\x1b\x61\x00'  # Left align
-        FEED = b'\r\n\r\n\r\n\r\n\r\n\r\n'  # Feed paper
-
-        # Build the print job
-        now = datetime.now()
-        time_str = now.strftime("%H:%M:%S")
-        date_str = now.strftime("%B %d, %Y").replace(" 0", " ")
-
-        # Wrap text to 48 characters (typical for 80mm thermal paper)
-        wrapped_message = textwrap.fill(message, width=48)
-
-        data = INIT
-        data += b"\r\n"
-        data += LEFT
-        data += wrapped_message.encode('cp1252', errors='replace')
-        data += b"\r\n\r\n"
-        data += f"-- from {visitor_ip}\r\n".encode('cp1252')
-        data += f"   at {time_str} of {date_str}\r\n".encode('cp1252')
-        data += FEED
-
-        sock.send(data)
-        sock.close()
-        return True, "Message sent to printer!"
+        # The usual case: PRINTER_HOST is a literal IPv4 address
+        socket.inet_aton(PRINTER_HOST)
+        return socket.AF_INET, (PRINTER_HOST, PRINTER_PORT)
+    except OSError:
+        pass
+    try:
+        info = socket.getaddrinfo(PRINTER_HOST, PRINTER_PORT,
+                                  socket.AF_INET, socket.SOCK_STREAM)
+        return info[0][0], info[0][4]
+    except OSError:
+        # Unresolvable right now - let connect() resolve it per attempt
+        return socket.AF_INET, (PRINTER_HOST, PRINTER_PORT)
+
+
+_PRINTER_FAMILY, _PRINTER_SOCKADDR = _resolve_printer_addr()
+
+
+def _connect_printer():
+    """Open a new connection to the printer bridge."""
+    sock = socket.socket(_PRINTER_FAMILY, socket.SOCK_STREAM)
+    # Disable Nagle's algorithm - each job is one small send(), so
+    # waiting for more data just adds latency per print
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    # Keepalive so a long-idle connection gets noticed if the bridge dies
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    # Fail fast on a dead bridge: a short connect timeout, then the more
+    # generous send/recv timeout once the connection is up
+    sock.settimeout(1.0)
+    sock.connect(_PRINTER_SOCKADDR)
+    sock.settimeout(5.0)
+    return sock
+
+
+def _close_printer_sock():
+    """Close the persistent connection (if any) gracefully."""
+    global _printer_sock
+    with _printer_lock:
+        _close_printer_sock_locked()
+
+
+def _close_printer_sock_locked():
+    global _printer_sock
+    if _printer_sock is not None:
+        try:
+            # Send FIN so the bridge sees end-of-stream instead of an RST
+            # that could discard bytes it hasn't read yet
+            _printer_sock.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+        try:
+            _printer_sock.close()
+        except OSError:
+            pass
+        _printer_sock = None
+
+
+atexit.register(_close_printer_sock)
+
+
+def build_print_payload(message, visitor_ip):
+    """Build the full ESC/POS byte payload for one message."""
+    now = datetime.now()
+    time_str = now.strftime("%H:%M:%S")
+    # now.day is an int, so no leading zero to strip
+    date_str = f"{now.strftime('%B')} {now.day}, {now.year}"
+
+    return b"".join([
+        PRELUDE,
+        _encode_body(message),
+        b"\r\n\r\n",
+        _encode_printer_text(f"-- from {visitor_ip}\r\n   at {time_str} of {date_str}\r\n"),
+        FEED,
+    ])
+
+
+def send_payload(data):
+    """Send a prebuilt payload to the thermal printer via TCP bridge."""
+    global _printer_sock
+    try:
+        # Reuse the persistent connection; reconnect and retry once if the
+        # bridge dropped it while we were idle
+        with _printer_lock:
+            for attempt in range(2):
+                if _printer_sock is None:
+                    _printer_sock = _connect_printer()
+                try:
+                    _printer_sock.sendall(data)
+                    return True, "Message sent to printer!"
+                except (BrokenPipeError, ConnectionResetError):
+                    _close_printer_sock()
+                    if attempt == 1:
+                        return False, "Connection lost - is the printer bridge running?"
     except socket.timeout:
+        _close_printer_sock()
         return False, "Connection timed out - is the printer bridge running?"
     except ConnectionRefusedError:
+        _close_printer_sock()
         return False, "Connection refused - is the printer bridge running?"
     except Exception as e:
+        _close_printer_sock()
         return False, f"Error: {str(e)}"
 
 
+# Start the print worker now that everything it calls is defined (a job
+# loaded from the journal could otherwise be picked up too early)
+worker_thread = threading.Thread(target=print_worker, daemon=True)
+worker_thread.start()
+
+# Load any pending jobs from previous run, then normalise the journal
+load_pending_queue()
+compact_queue_file()
+
+# Compact once more on shutdown so only pending jobs survive, and let
+# the worker finish what it can (atexit runs these last-in first-out)
+atexit.register(compact_queue_file)
+atexit.register(stop_print_worker)
+
+
 # =============================================================================
 # Routes
 # =============================================================================
 
+# The manifest never changes at runtime, so serialize it once
+_MANIFEST_BYTES = json.dumps({
+    "name": "Send me a message",
+    "short_name": "Message",
+    "description": "Send a message to Paulo's thermal printer",
+    "start_url": "/",
+    "display": "standalone",
+    "background_color": "#0a0a0a",
+    "theme_color": "#0a0a0a",
+    "icons": [
+        {
+            "src": f"/static/apple-touch-icon.png?v={STATIC_VERSION}",
+            "sizes": "180x180",
+            "type": "image/png"
+        },
+        {
+            "src": f"/static/icon-192.png?v={STATIC_VERSION}",
+            "sizes": "192x192",
+            "type": "image/png"
+        },
+        {
+            "src": f"/static/icon-512.png?v={STATIC_VERSION}",
+            "sizes": "512x512",
+            "type": "image/png"
+        }
+    ]
+}).encode('utf-8')
+
+
 @app.route('/manifest.json')
 def manifest():
-    return {
-        "name": "Send me a message",
-        "short_name": "Message",
-        "description": "Send a message to Paulo's thermal printer",
-        "start_url": "/",
-        "display": "standalone",
-        "background_color": "#0a0a0a",
-        "theme_color": "#0a0a0a",
-        "icons": [
-            {
-                "src": "/static/apple-touch-icon.png",
-                "sizes": "180x180",
-                "type": "image/png"
-            },
-            {
-                "src": "/static/icon-192.png",
-                "sizes": "192x192",
-                "type": "image/png"
-            },
-            {
-                "src": "/static/icon-512.png",
-                "sizes": "512x512",
-                "type": "image/png"
-            }
-        ]
-    }
+    return Response(_MANIFEST_BYTES, mimetype='application/manifest+json',
+                    headers={'Cache-Control': 'public, max-age=86400'})
+
+
+def get_visitor_ip(req):
+    """Best-effort client IP: Cloudflare's header, then X-Forwarded-For,
+    then the peer address. Short-circuits so the fallbacks are only
+    looked up when needed."""
+    ip = req.headers.get('CF-Connecting-IP')
+    if ip:
+        return ip
+    forwarded = req.headers.get('X-Forwarded-For')
+    if forwarded:
+        # May be a "client, proxy1, proxy2" chain - the client comes first
+        return forwarded.split(',', 1)[0].strip()
+    return req.remote_addr
 
 
 @app.route('/', methods=['GET', 'POST'])
 def index():
-    form = MessageForm()
+    # Double-submit CSRF: a random token lives in a cookie and must be
+    # echoed back by the form's hidden input. No HMAC signing, no
+    # itsdangerous, no session read - just a constant-time compare on POST.
+    # Never trust the cookie's value: it is stamped into the page bytes
+    # unescaped, so anything outside the token alphabet (a sibling-domain
+    # or MITM-injected cookie) is discarded and re-minted
+    token = request.cookies.get('csrf')
+    new_cookie = token is None or not _CSRF_TOKEN_RE.fullmatch(token)
+    if new_cookie:
+        token = secrets.token_urlsafe(24)
+
+    # Fast path: plain GET with nothing flashed serves the prebaked page,
+    # only stamping in the visitor's CSRF token
+    if request.method == 'GET' and '_flashes' not in session:
+        body = _PREBAKED_HTML.replace(_CSRF_PLACEHOLDER, token.encode('ascii'))
+
+        # Same cookie means same token means same bytes, so a body hash
+        # is a stable validator: repeat visits revalidate with a 304
+        # instead of re-downloading the page
+        etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+        gzip_etag = etag[:-1] + '-gzip"'
+        client_etag = request.headers.get('If-None-Match')
+        if client_etag in (etag, gzip_etag):
+            # Echo the validator and caching policy so caches can
+            # refresh their stored entry (RFC 9110 §15.4.5)
+            return Response(status=304, headers={'ETag': client_etag,
+                                                 'Cache-Control': 'no-cache',
+                                                 'Vary': 'Accept-Encoding'})
+
+        resp = Response(body, mimetype='text/html')
+        # The page can't be gzipped ahead of time while the per-visitor
+        # CSRF token is stamped into it, but compressing a few KB here is
+        # still far cheaper than sending it uncompressed
+        if 'gzip' in request.headers.get('Accept-Encoding', ''):
+            resp.set_data(gzip.compress(body, 6))
+            resp.headers['Content-Encoding'] = 'gzip'
+            etag = gzip_etag
+        resp.headers['ETag'] = etag
+        resp.headers['Cache-Control'] = 'no-cache'
+        resp.headers['Vary'] = 'Accept-Encoding'
+        if new_cookie:
+            resp.set_cookie('csrf', token, httponly=True, samesite='Lax')
+        return resp
+
+    # Check the honeypot before building the form at all: bots that fill
+    # it get a fake success without costing us CSRF verification or form
+    # population
+    if request.method == 'POST' and request.form.get('website'):
+        flash('Message queued for printing!', 'success')
+        return redirect(url_for('index'))
+
+    form = MessageForm(request.form)
 
     if request.method == 'POST':
-        # Check honeypot field first
-        honeypot = request.form.get('website', '')
-        if honeypot:
-            # Bot detected! Pretend success but do nothing
-            flash('Message queued for printing!', 'success')
+        # The hidden input must echo the csrf cookie; a missing cookie
+        # (new_cookie) can never match. Compare as bytes: compare_digest
+        # raises on non-ASCII str, and bots do send garbage
+        if new_cookie or not hmac.compare_digest(
+                request.form.get('_csrf', '').encode('utf-8', 'replace'),
+                token.encode('ascii')):
+            flash('Your form expired - please try sending again', 'error')
             return redirect(url_for('index'))
-
-        if form.validate_on_submit():
+        if form.validate():
             message = form.message.data.strip()
-            visitor_ip = request.headers.get(
-                'CF-Connecting-IP',
-                request.headers.get('X-Forwarded-For', request.remote_addr)
-            )
+            visitor_ip = get_visitor_ip(request)
 
             # Check rate limit
             allowed, remaining = check_rate_limit(visitor_ip)
             if not allowed:
                 flash(f'Please wait {remaining} seconds before sending another message', 'error')
-                return render_template_string(HTML_TEMPLATE, form=form)
+                return _TEMPLATE.render(form=form, csrf_token=token,
+                                        messages=get_flashed_messages(with_categories=True))
 
             # Queue the print job
-            queue_position = queue_print_job(message, visitor_ip)
-            record_submission(visitor_ip)
-            save_message(message, visitor_ip)
+            # One timestamp per submission, shared by the queue entry,
+            # the rate limiter, and the archive record
+            now = datetime.now()
+            queue_position = queue_print_job(message, visitor_ip, now)
+            record_submission(visitor_ip, now.timestamp())
+            save_message(message, visitor_ip, now)
 
             if queue_position == 1:
                 flash('Message queued for printing!', 'success')
@@ -579,7 +1074,12 @@ def index():
                 for error in errors:
                     flash(error, 'error')
 
-    return render_template_string(HTML_TEMPLATE, form=form)
+    resp = Response(_TEMPLATE.render(form=form, csrf_token=token,
+                                     messages=get_flashed_messages(with_categories=True)),
+                    mimetype='text/html')
+    if new_cookie:
+        resp.set_cookie('csrf', token, httponly=True, samesite='Lax')
+    return resp
 
 
 # =============================================================================
@@ -595,4 +1095,22 @@ if __name__ == '__main__':
 
     # Only use debug mode if explicitly set
     debug_mode = os.environ.get('FLASK_DEBUG', 'false').lower() == 'true'
+
+    # Prefer gevent when available: the Werkzeug dev server is single-
+    # threaded, so concurrent POSTs serialize behind the printer's 5s
+    # timeout. With gevent each request waits cooperatively instead.
+    # (Debug mode keeps the Werkzeug server for the reloader/debugger.)
+    if not debug_mode:
+        try:
+            from gevent import monkey, pywsgi
+        except ImportError:
+            pass
+        else:
+            # Patching module attributes in place also covers the socket
+            # calls above, since they look up socket.socket at call time
+            monkey.patch_all()
+            print("Serving with gevent")
+            pywsgi.WSGIServer(('0.0.0.0', 5000), app).serve_forever()
+            raise SystemExit(0)
+
     app.run(host='0.0.0.0', port=5000, debug=debug_mode)
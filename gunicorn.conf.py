@@ -7,11 +7,16 @@ import multiprocessing
 bind = "0.0.0.0:5000"
 
 # Number of worker processes
-# Using 1 worker because the print queue is in-memory and not shared between workers
+# Using 1 worker because the print queue is in-memory and not shared between
+# workers. If this ever needs more workers, the queue (and the rate-limit
+# dict) must first move out of the process, e.g. into a separate printer
+# daemon fed over a socket — don't just bump this number.
 workers = 1
 
-# Worker class - sync is fine for this simple app
-worker_class = "sync"
+# Worker class - requests block on printer/disk I/O, so threads let them
+# overlap within the single worker instead of serializing
+worker_class = "gthread"
+threads = 8
 
 # Timeout for worker processes (seconds)
 timeout = 30